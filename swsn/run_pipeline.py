@@ -1,25 +1,20 @@
-import subprocess
-import sys
 import os
 
-def run_script(script_name):
-    """Runs a Python script as a subprocess."""
+from generate_data import create_data_files
+from working_functions import main as run_analysis
+from visualize_graphs import render_all
+
+def run_stage(stage_name, stage_func):
+    """Runs one pipeline stage in this process and reports whether it succeeded."""
     print(f"\n{'='*50}")
-    print(f"RUNNING: {script_name}")
+    print(f"RUNNING: {stage_name}")
     print(f"{'='*50}\n")
-    
-    # Check if file exists
-    if not os.path.exists(script_name):
-        print(f"ERROR: File {script_name} not found")
-        return False
 
     try:
-        # Run the script and wait for completion
-        # sys.executable guarantees using the same python interpreter
-        result = subprocess.run([sys.executable, script_name], check=True)
-        return result.returncode == 0
-    except subprocess.CalledProcessError as e:
-        print(f"ERROR while running {script_name}: {e}")
+        # Stages share this interpreter, so pandas/genai/matplotlib are imported only once
+        return stage_func() is not False
+    except Exception as e:
+        print(f"ERROR while running {stage_name}: {e}")
         return False
 
 def main():
@@ -33,25 +28,25 @@ def main():
             print("Continuing without setting key (step 2 might fail)...")
 
     # STEP 1: Data Generation
-    if not run_script("generate_data.py"):
+    if not run_stage("generate_data", create_data_files):
         print("Aborted: Data generation error.")
         return
 
     # STEP 2: LLM Analysis (This will take the longest)
     print("\nStarting AI analysis. This may take a while...")
-    if not run_script("working_functions.py"):
+    if not run_stage("working_functions", run_analysis):
         print("Aborted: Error during LLM analysis.")
         return
 
     # STEP 3: Visualization
-    if not run_script("visualize_graphs.py"):
+    if not run_stage("visualize_graphs", render_all):
         print("Aborted: Error generating graphs.")
         return
 
     print(f"\n{'='*50}")
     print("SUCCESS! Pipeline finished.")
-    print("Results found in 'output_graphs' folder and CSV file.")
+    print("Results found in 'output_graphs' folder and FINAL_report.parquet.")
     print(f"{'='*50}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
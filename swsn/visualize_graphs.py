@@ -1,27 +1,118 @@
 import pandas as pd
-import json
+import numpy as np
+import orjson
 import networkx as nx
+from numba import njit
+import matplotlib
+matplotlib.use('Agg')  # worker processes render straight to files, no display needed
 import matplotlib.pyplot as plt
 import os
-
-def visualize_csv_row(csv_path, row_index=0, output_dir="output_graphs"):
-    """Create the knowledge graphs"""
+import concurrent.futures
+
+GRAPH_COLUMNS = ['id', 'Accuracy_graph', 'Completeness_graph', 'Empathy_graph']
+FAST_LAYOUT_MAX_NODES = 500  # above this networkx's own solver ('auto' -> L-BFGS energy) takes over
+
+_canvas = None
+
+def get_canvas():
+    """One Figure per process, cleared and redrawn for every graph instead of reallocated."""
+    global _canvas
+    if _canvas is None:
+        _canvas = plt.subplots(figsize=(14, 10))
+        # Fixed margins instead of tight_layout() re-measuring every graph
+        _canvas[0].subplots_adjust(left=0.02, right=0.98, top=0.95, bottom=0.02)
+    return _canvas
+
+@njit(fastmath=True, cache=True)
+def _fr_numba(pos, edges, iterations, k, threshold=1e-4):
+    """
+    Fruchterman-Reingold iterations on an (n, 2) float32 position array and an (E, 2) int32
+    edge array, same force model and cooling schedule as networkx's dense implementation.
+    """
+    n = pos.shape[0]
+    disp = np.zeros_like(pos)
+
+    t = max(pos[:, 0].max() - pos[:, 0].min(), pos[:, 1].max() - pos[:, 1].min()) * 0.1
+    dt = t / (iterations + 1)
+
+    for _ in range(iterations):
+        disp[:] = 0.0
+
+        # Repulsion between every pair of nodes
+        for i in range(n):
+            for j in range(n):
+                if i == j:
+                    continue
+                dx = pos[i, 0] - pos[j, 0]
+                dy = pos[i, 1] - pos[j, 1]
+                dist = max(np.sqrt(dx * dx + dy * dy), 0.01)
+                force = k * k / (dist * dist)
+                disp[i, 0] += dx * force
+                disp[i, 1] += dy * force
+
+        # Attraction along edges (pulls the source, as networkx does for directed graphs)
+        for e in range(edges.shape[0]):
+            s, d = edges[e, 0], edges[e, 1]
+            if s == d:
+                continue
+            dx = pos[s, 0] - pos[d, 0]
+            dy = pos[s, 1] - pos[d, 1]
+            dist = max(np.sqrt(dx * dx + dy * dy), 0.01)
+            force = dist / k
+            disp[s, 0] -= dx * force
+            disp[s, 1] -= dy * force
+
+        # Move each node at most t, then cool down
+        moved = 0.0
+        for i in range(n):
+            length = max(np.sqrt(disp[i, 0] ** 2 + disp[i, 1] ** 2), 0.01)
+            step_x = disp[i, 0] * t / length
+            step_y = disp[i, 1] * t / length
+            pos[i, 0] += step_x
+            pos[i, 1] += step_y
+            moved += np.sqrt(step_x * step_x + step_y * step_y)
+        t -= dt
+
+        if moved / n < threshold:
+            break
+
+    return pos
+
+def fast_spring_layout(G, k, iterations=50, seed=None):
+    """Drop-in for nx.spring_layout on small graphs, running the force loop in _fr_numba."""
+    nodes = list(G)
+    if len(nodes) > FAST_LAYOUT_MAX_NODES:
+        return nx.spring_layout(G, k=k, iterations=iterations, seed=seed, method='auto')
+
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = np.array([(index[u], index[v]) for u, v in G.edges()], dtype=np.int32).reshape(-1, 2)
+    pos = np.random.default_rng(seed).random((len(nodes), 2), dtype=np.float32)
+
+    pos = _fr_numba(pos, edges, iterations, np.float32(k))
+    pos = nx.rescale_layout(pos.astype(np.float64))
+    return dict(zip(nodes, pos))
+
+def load_edges(row, criteria, answer_id):
+    """Returns the edge list stored in the {criteria}_graph column, or [] if missing/broken."""
+    col_name = f"{criteria}_graph"
+
+    if col_name not in row or pd.isna(row[col_name]):
+        return []
     try:
-        df = pd.read_csv(csv_path)
-    except FileNotFoundError:
-        print(f"Error: File {csv_path} not found.")
-        return
+        graph_data = orjson.loads(row[col_name])
+    except orjson.JSONDecodeError:
+        print(f"Warning: Could not parse JSON for {criteria} in row with ID {answer_id}")
+        return []
 
-    if row_index >= len(df):
-        print(f"Error: Row index {row_index} out of bounds. Max is {len(df)-1}.")
-        return
+    if not isinstance(graph_data, dict):
+        return []
+    return graph_data.get('edges') or []
 
-    row = df.iloc[row_index]
+def visualize_csv_row(row, output_dir="output_graphs", ax=None):
+    """Create the knowledge graphs for one report row (a dict of GRAPH_COLUMNS)"""
     answer_id = row.get('id', 'Unknown')
     print(f"Visualizing Graph for Answer ID: {answer_id}")
 
-    G = nx.DiGraph()
-
     color_map = {
         "Accuracy": "#FF9999",     # Red
         "Completeness": "#99CCFF", # Blue
@@ -31,78 +122,84 @@ def visualize_csv_row(csv_path, row_index=0, output_dir="output_graphs"):
 
     criteria_list = ["Accuracy", "Completeness", "Empathy"]
 
-    for criteria in criteria_list:
-        col_name = f"{criteria}_graph"
-
-        if col_name in row and pd.notna(row[col_name]):
-            try:
-                graph_data = json.loads(row[col_name])
-                edges = graph_data.get('edges', [])
-                if not edges: continue
+    edge_rows = [
+        (edge.get('source'), edge.get('target'), edge.get('relationship', 'relates'), criteria)
+        for criteria in criteria_list
+        for edge in load_edges(row, criteria, answer_id)
+        if edge.get('source') and edge.get('target')
+    ]
+    edf = pd.DataFrame(edge_rows, columns=['source', 'target', 'label', 'agent'])
 
-                for edge in edges:
-                    source = edge.get('source')
-                    target = edge.get('target')
-                    relation = edge.get('relationship', 'relates')
+    G = nx.from_pandas_edgelist(edf, 'source', 'target', ['label', 'agent'], create_using=nx.DiGraph)
 
-                    if source and target:
-                        G.add_edge(source, target, label=relation, agent=criteria)
-
-                        if source not in G.nodes:
-                            G.nodes[source]['agent'] = criteria
-                        if target not in G.nodes:
-                            G.nodes[target]['agent'] = criteria
-
-            except json.JSONDecodeError:
-                print(f"Warning: Could not parse JSON for {criteria} in row {row_index}")
+    # A node takes the colour of the first agent that mentions it: endpoints are interleaved
+    # per edge (source, target, source, target, ...) so edge order decides, not the role
+    node_agents = pd.DataFrame({
+        'node': edf[['source', 'target']].to_numpy().ravel(),
+        'agent': edf['agent'].repeat(2).to_numpy()
+    }).drop_duplicates('node')
+    nx.set_node_attributes(G, dict(zip(node_agents['node'], node_agents['agent'])), 'agent')
 
     if G.number_of_nodes() == 0:
         print(f"Graph is empty for ID {answer_id}. No edges found.")
         return
 
-    pos = nx.spring_layout(G, k=0.8, iterations=50)
-    plt.figure(figsize=(14, 10))
+    # Critique graphs are small, so the JIT-compiled force loop handles them; large graphs go
+    # to networkx's L-BFGS energy solver. 30 iterations are plenty and the fixed seed keeps
+    # layouts reproducible between runs.
+    pos = fast_spring_layout(G, k=0.8, iterations=30, seed=42)
+
+    if ax is None:
+        _, ax = get_canvas()
+    fig = ax.figure
+    ax.clear()
 
     colors = [color_map.get(G.nodes[n].get('agent', 'Input'), '#CCCCCC') for n in G.nodes]
 
-    nx.draw_networkx_nodes(G, pos, node_size=2500, node_color=colors, alpha=0.9, edgecolors='black')
+    nx.draw_networkx_nodes(G, pos, ax=ax, node_size=2500, node_color=colors, alpha=0.9, edgecolors='black')
 
-    nx.draw_networkx_labels(G, pos, font_size=9, font_family="sans-serif",
+    nx.draw_networkx_labels(G, pos, ax=ax, font_size=9, font_family="sans-serif",
                             bbox=dict(facecolor='white', alpha=0.5, edgecolor='none', pad=2))
 
-    nx.draw_networkx_edges(G, pos, width=2, alpha=0.6, edge_color='gray', arrowsize=25, min_source_margin=20, min_target_margin=20)
+    nx.draw_networkx_edges(G, pos, ax=ax, width=2, alpha=0.6, edge_color='gray', arrowsize=25, min_source_margin=20, min_target_margin=20)
 
     edge_labels = nx.get_edge_attributes(G, 'label')
-    nx.draw_networkx_edge_labels(G, pos, edge_labels=edge_labels, font_size=8, label_pos=0.5)
+    nx.draw_networkx_edge_labels(G, pos, ax=ax, edge_labels=edge_labels, font_size=8, label_pos=0.5)
 
-    plt.title(f"Critique Graph for Answer #{answer_id}")
-    plt.axis('off')
-    plt.tight_layout()
+    ax.set_title(f"Critique Graph for Answer #{answer_id}")
+    ax.axis('off')
     
     # Zapisz do pliku zamiast wyświetlać
     filename = os.path.join(output_dir, f"graph_id_{answer_id}.png")
-    plt.savefig(filename)
-    plt.close()
+    fig.savefig(filename, dpi=100, pil_kwargs={'optimize': False})
     print(f"Saved graph to {filename}")
 
+def _render_one(row, output_dir="output_graphs"):
+    try:
+        visualize_csv_row(row, output_dir=output_dir)
+    except Exception as e:
+        print(f"Error in row with ID {row.get('id')}: {e}")
 
-if __name__ == "__main__":
-    csv_file_path = 'FINAL_threaded_report_with_graphs.csv'
-    output_dir = "output_graphs"
-    
+
+def render_all(report_path='FINAL_report.parquet', output_dir="output_graphs"):
+    """Renders a graph for every row of the report; returns False if there is no report."""
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    if not os.path.exists(csv_file_path):
-        print(f"Plik {csv_file_path} nie istnieje. Uruchom najpierw skrypt oceniający.")
-    else:
-        # Możesz zmienić zakres, aby wygenerować mniej wykresów, np. range(0, 5)
-        df = pd.read_csv(csv_file_path)
-        total_rows = len(df)
-        print(f"Znaleziono {total_rows} wierszy do przetworzenia.")
-        
-        for i in range(total_rows):
-            try:
-                visualize_csv_row(csv_file_path, row_index=i, output_dir=output_dir)
-            except Exception as e:
-                print(f"Error in row {i}: {e}")
+    if not os.path.exists(report_path):
+        print(f"Plik {report_path} nie istnieje. Uruchom najpierw skrypt oceniający.")
+        return False
+
+    # Możesz ograniczyć liczbę wierszy, aby wygenerować mniej wykresów, np. df.head(5)
+    df = pd.read_parquet(report_path, columns=GRAPH_COLUMNS)
+    total_rows = len(df)
+    print(f"Znaleziono {total_rows} wierszy do przetworzenia.")
+
+    # Rendering is CPU-bound (layout + matplotlib), so spread rows over processes
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        list(executor.map(_render_one, df.to_dict('records'), [output_dir] * total_rows, chunksize=8))
+    return True
+
+
+if __name__ == "__main__":
+    render_all()
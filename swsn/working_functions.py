@@ -1,31 +1,117 @@
-import json
+import orjson
 import time
-import concurrent.futures
+import asyncio
+import hashlib
+import sqlite3
+import functools
+import random
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import google.generativeai as genai
-from google.generativeai.types import content_types
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable
 import os
 import sys
 
 # Konfiguracja API
-GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
-if not GOOGLE_API_KEY:
-    print("Error: GOOGLE_API_KEY environment variable not set.")
-    sys.exit(1)
-
-genai.configure(api_key=GOOGLE_API_KEY)
-print("Gemini API configured globally.")
-
-MAX_WORKERS = 3
+def configure_api():
+    """Configures Gemini from GOOGLE_API_KEY; returns False when the key is missing."""
+    api_key = os.getenv('GOOGLE_API_KEY')
+    if not api_key:
+        print("Error: GOOGLE_API_KEY environment variable not set.")
+        return False
+
+    genai.configure(api_key=api_key)
+    print("Gemini API configured globally.")
+    return True
+
+MAX_CONCURRENT = 16       # Gemini requests in flight at once
+REQUESTS_PER_SECOND = 5   # token bucket refill rate (keep under the RPM quota)
+
+BATCH_SIZE = 10           # answers packed into a single judge request
+INPUT_CHUNK_SIZE = 5000   # input rows read from the CSV at a time
+RETRY_ATTEMPTS = 3        # tries per request on 429 / 503 before giving up
+
+MODEL_VERSION = 'gemini-2.5-flash'
+CACHE_PATH = ".gemini_cache.sqlite"
+OUTPUT_PATH = "FINAL_report.parquet"
+VERDICT_KEYS = ('score', 'explanation')  # a judge reply without these is never cached
+
+# RATE LIMITER
+def create_rate_limiter(rate, capacity=None):
+    """Token bucket: returns a coroutine that waits until a request may be sent."""
+    capacity = capacity or rate
+    lock = asyncio.Lock()
+    bucket = {"tokens": capacity, "last": time.monotonic()}
+
+    async def acquire():
+        async with lock:
+            while True:
+                now = time.monotonic()
+                bucket["tokens"] = min(capacity, bucket["tokens"] + (now - bucket["last"]) * rate)
+                bucket["last"] = now
+                if bucket["tokens"] >= 1:
+                    bucket["tokens"] -= 1
+                    return
+                await asyncio.sleep((1 - bucket["tokens"]) / rate)
+
+    return acquire
+
+# RESPONSE CACHE
+_cache_conn = None
+
+def get_cache():
+    """Opens (once) the on-disk sqlite cache of judge responses."""
+    global _cache_conn
+    if _cache_conn is None:
+        _cache_conn = sqlite3.connect(CACHE_PATH)
+        _cache_conn.execute("CREATE TABLE IF NOT EXISTS judgments (key TEXT PRIMARY KEY, value TEXT)")
+    return _cache_conn
+
+def cache_key(criteria_name, content):
+    digest = hashlib.sha256(str(content).encode('utf-8')).hexdigest()
+    return f"{criteria_name}:{digest}:{MODEL_VERSION}"
+
+def is_valid_verdict(verdict):
+    return isinstance(verdict, dict) and all(key in verdict for key in VERDICT_KEYS)
+
+def cache_lookup(key):
+    hit = get_cache().execute("SELECT value FROM judgments WHERE key = ?", (key,)).fetchone()
+    if not hit:
+        return None
+    verdict = orjson.loads(hit[0])
+    # Entries written before verdicts were validated are treated as misses
+    return verdict if is_valid_verdict(verdict) else None
+
+def cache_store(key, result):
+    cache = get_cache()
+    cache.execute("INSERT OR REPLACE INTO judgments (key, value) VALUES (?, ?)", (key, orjson.dumps(result).decode()))
+    cache.commit()
+
+def cached_judgment(func):
+    """Skips the API call when this (criteria, content) pair was already judged."""
+    @functools.wraps(func)
+    async def wrapper(criteria_name, criteria_desc, content, throttle):
+        key = cache_key(criteria_name, content)
+
+        hit = cache_lookup(key)
+        if hit is not None:
+            return hit
+
+        result = await func(criteria_name, criteria_desc, content, throttle)
+        cache_store(key, result)
+        return result
+
+    return wrapper
 
 # LLM JUDGE
-def run_judgment_llm(criteria_name, criteria_desc, content):
-    """
-    Evaluates text and extracts a knowledge graph of the reasoning.
-    """
-    judge_model = genai.GenerativeModel('gemini-2.5-flash')
+# Built once and shared by every call instead of per judgment
+_JUDGE_MODEL = genai.GenerativeModel(
+    MODEL_VERSION,
+    generation_config={"response_mime_type": "application/json"}
+)
 
-    prompt = f"""
+_PROMPT_TMPL = """
     ROLE: Specialized Evaluator for {criteria_name}.
     TASK: Analyze the "Content" against the "Criteria".
 
@@ -41,12 +127,58 @@ def run_judgment_llm(criteria_name, criteria_desc, content):
        - Map the logic. E.g., "Input Text" -> "LACKS" -> "Empathy".
     """
 
+_BATCH_PROMPT_TMPL = """
+    ROLE: Specialized Evaluator for {criteria_name}.
+    TASK: Evaluate the following {count} items independently against the "Criteria".
+
+    CRITERIA DESCRIPTION: {criteria_desc}
+{items}
+
+    OUTPUT FORMAT: Return a valid JSON list of exactly {count} objects, one per item, in item order. Each object has:
+    1. "score": 1 (Pass) or 0 (Fail).
+    2. "explanation": A brief explanation.
+    3. "graph_nodes": A list of objects {{"id": "concept_or_claim", "type": "tag"}}.
+       - Extract key concepts from the text relevant to the critique.
+    4. "graph_edges": A list of objects {{"source": "id", "target": "id", "relationship": "verb"}}.
+       - Map the logic. E.g., "Input Text" -> "LACKS" -> "Empathy".
+    """
+
+async def generate_with_retry(prompt, throttle):
+    """
+    Retries transient quota/availability errors with exponential backoff and jitter.
+    Every attempt (retries included) takes a rate limiter token; cache hits never get here.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            await throttle()
+            return await _JUDGE_MODEL.generate_content_async(prompt)
+        except (ResourceExhausted, ServiceUnavailable) as e:
+            if attempt == RETRY_ATTEMPTS - 1:
+                raise
+            delay = 2 ** attempt + random.random()
+            print(f"   >>> Gemini busy ({type(e).__name__}), retry {attempt + 1} in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+
+@cached_judgment
+async def ask_judge(criteria_name, criteria_desc, content, throttle):
+    """Single Gemini call; raises on failure so errors never end up in the cache."""
+    prompt = _PROMPT_TMPL.format_map({
+        'criteria_name': criteria_name,
+        'criteria_desc': criteria_desc,
+        'content': content
+    })
+    response = await generate_with_retry(prompt, throttle)
+    verdict = orjson.loads(response.text)
+    if not is_valid_verdict(verdict):
+        raise ValueError(f"malformed verdict: {str(verdict)[:100]}")
+    return verdict
+
+async def run_judgment_llm(criteria_name, criteria_desc, content, throttle):
+    """
+    Evaluates text and extracts a knowledge graph of the reasoning.
+    """
     try:
-        response = judge_model.generate_content(
-            prompt,
-            generation_config={"response_mime_type": "application/json"}
-        )
-        return json.loads(response.text)
+        return await ask_judge(criteria_name, criteria_desc, content, throttle)
     except Exception as e:
         return {
             "score": 0,
@@ -55,185 +187,229 @@ def run_judgment_llm(criteria_name, criteria_desc, content):
             "graph_edges": []
         }
 
-# TOOL CREATION (Placeholders for tool calls)
-def check_accuracy(text_content: str):
-    """Validates if the text is factually correct."""
-    return "This is a placeholder. The logic happens in handle_tool_call."
-
-def check_completeness(text_content: str):
-    """Checks if the text answers all parts comprehensively."""
-    return "This is a placeholder. The logic happens in handle_tool_call."
-
-def check_empathy(text_content: str):
-    """Checks if the tone is appropriate and supportive."""
-    return "This is a placeholder. The logic happens in handle_tool_call."
-
-# AGENT FACTORY
-def create_agent(agent_name, tool_function, criteria_desc):
-
-    tools_for_model = [tool_function]
-
-    system_instruction = f"""
-    ROLE: {agent_name} Validator.
-    TASK: You are a classifier.
-    1. Receive user text.
-    2. IMMEDIATELY call the function '{tool_function.__name__}'.
-    3. Pass the user text into the tool's 'text_content' argument.
+async def ask_judge_batch(criteria_name, criteria_desc, contents, throttle):
+    """One Gemini call for several answers; returns the verdicts in input order or raises."""
+    items = "\n".join(f"    ITEM {i}: {content}" for i, content in enumerate(contents, 1))
+
+    prompt = _BATCH_PROMPT_TMPL.format_map({
+        'criteria_name': criteria_name,
+        'criteria_desc': criteria_desc,
+        'count': len(contents),
+        'items': items
+    })
+    response = await generate_with_retry(prompt, throttle)
+    verdicts = orjson.loads(response.text)
+    if not isinstance(verdicts, list) or len(verdicts) != len(contents):
+        raise ValueError(f"expected {len(contents)} verdicts, got {len(verdicts) if isinstance(verdicts, list) else 'no list'}")
+    if not all(is_valid_verdict(verdict) for verdict in verdicts):
+        raise ValueError("batch contains malformed verdicts")
+    return verdicts
+
+async def run_judgment_llm_batch(criteria_name, criteria_desc, contents, throttle):
     """
+    Evaluates several texts with a single request, sending only the ones not cached yet.
+    Returns None when the batched answer is unusable, so the caller can fall back to single calls.
+    """
+    keys = [cache_key(criteria_name, content) for content in contents]
+    results = [cache_lookup(key) for key in keys]
 
-    chat_model = genai.GenerativeModel(
-        'gemini-2.5-flash',
-        tools=tools_for_model,
-        system_instruction=system_instruction
-    )
-
-    def handle_tool_call(tool_call, context_text):
-        print(f"   >>> {agent_name} is judging...")
-
-        input_text = context_text
-        if tool_call.args and 'text_content' in tool_call.args:
-            input_text = tool_call.args['text_content']
-
-        result = run_judgment_llm(
-            criteria_name=agent_name,
-            criteria_desc=criteria_desc,
-            content=input_text
-        )
-
-        print(f"   >>> {agent_name} Score: {result.get('score')}")
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
 
-        return {
-            "status": "success",
-            "judgment_score": result.get('score'),
-            "judgment_reason": result.get('explanation'),
-            "graph_nodes": result.get('graph_nodes', []),
-            "graph_edges": result.get('graph_edges', [])
-        }
+    try:
+        verdicts = await ask_judge_batch(criteria_name, criteria_desc, [contents[i] for i in missing], throttle)
+    except Exception as e:
+        print(f"   >>> {criteria_name} batch failed ({e}), falling back to single calls.")
+        return None
 
-    return chat_model, handle_tool_call
+    for i, verdict in zip(missing, verdicts):
+        cache_store(keys[i], verdict)
+        results[i] = verdict
+    return results
 
-# THREADED WORKER
-def run_agent_threaded(agent_name, agent_model, handle_tool_call, user_query):
+# ASYNC WORKER
+def as_grade(score):
+    """The model sometimes answers "1" or 1.0 instead of 1; anything unreadable is a fail."""
+    try:
+        return int(float(score))
+    except (TypeError, ValueError, OverflowError):
+        return 0
+
+def format_verdict(agent_name, result):
+    """Flattens a verdict into report columns with the types fixed by report_schema."""
+    graph_data = {
+        "nodes": result.get('graph_nodes') or [],
+        "edges": result.get('graph_edges') or []
+    }
+    return {
+        f"{agent_name}_grade": as_grade(result.get('score')),
+        f"{agent_name}_reason": str(result.get('explanation') or ''),
+        f"{agent_name}_graph": orjson.dumps(graph_data).decode()
+    }
 
-    chat = agent_model.start_chat(history=[])
+async def run_agent_threaded(agent_name, criteria_desc, answers, semaphore, throttle):
+    """Judges a batch of answers on one criterion; returns one result dict per answer."""
 
-    forced_mode = content_types.to_tool_config({"function_calling_config": {"mode": "ANY"}})
-    auto_mode = content_types.to_tool_config({"function_calling_config": {"mode": "AUTO"}})
+    async with semaphore:
+        try:
+            print(f"   >>> {agent_name} is judging {len(answers)} answers...")
+            results = await run_judgment_llm_batch(agent_name, criteria_desc, answers, throttle)
 
-    final_data = {
-        f"{agent_name}_grade": 0,
-        f"{agent_name}_reason": "Failed to run",
-        f"{agent_name}_graph": "[]"
-    }
+            if results is None:
+                results = []
+                for answer in answers:
+                    results.append(await run_judgment_llm(agent_name, criteria_desc, answer, throttle))
 
-    try:
-        response = chat.send_message(user_query, tool_config=forced_mode)
-
-        if response.candidates and response.candidates[0].content.parts:
-            part = response.candidates[0].content.parts[0]
+            print(f"   >>> {agent_name} Scores: {[r.get('score') for r in results]}")
+            return [format_verdict(agent_name, result) for result in results]
 
-            if part.function_call:
+        except Exception as e:
+            print(f" {agent_name} crashed: {e}")
+            return [{
+                f"{agent_name}_grade": 0,
+                f"{agent_name}_reason": f"Error: {str(e)}",
+                f"{agent_name}_graph": "[]"
+            } for _ in answers]
 
-                result = handle_tool_call(part.function_call, context_text=user_query)
+# ORCHESTRATOR
+async def process_batch_threaded(rows, active_agents_dict, semaphore, throttle):
+    answers = [row.get('Answer') for row in rows]
+    batch_ids = f"{rows[0].get('id', 'Unknown')}..{rows[-1].get('id', 'Unknown')}"
 
-                if isinstance(result, dict):
-                    final_data[f"{agent_name}_grade"] = result.get('judgment_score', 0)
-                    final_data[f"{agent_name}_reason"] = result.get('judgment_reason', '')
+    print(f" [IDs: {batch_ids}] Starting parallel evaluation...")
 
-                    graph_data = {
-                        "nodes": result.get('graph_nodes'),
-                        "edges": result.get('graph_edges')
-                    }
-                    final_data[f"{agent_name}_graph"] = json.dumps(graph_data)
+    tasks = [
+        run_agent_threaded(name, desc, answers, semaphore, throttle)
+        for name, desc in active_agents_dict.items()
+    ]
 
-                tool_resp = genai.protos.Part(
-                    function_response=genai.protos.FunctionResponse(
-                        name=part.function_call.name,
-                        response={'result': result}
-                    )
-                )
-                chat.send_message([tool_resp], tool_config=auto_mode)
+    results_to_merge = [{} for _ in rows]
+    for data in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(data, Exception):
+            print(f"Task exc: {data}")
+            continue
+        for merged, verdict in zip(results_to_merge, data):
+            merged.update(verdict)
 
-    except Exception as e:
-        final_data[f"{agent_name}_reason"] = f"Error: {str(e)}"
-        print(f" {agent_name} crashed: {e}")
+    print(f" [IDs: {batch_ids}] Finished.")
+    return rows, results_to_merge
 
-    return final_data
+async def evaluate_all_rows(rows, active_agents_dict):
+    """
+    Dispatches every (batch x agent) pair at once, bounded by the semaphore and rate limiter.
+    Yields (batch_rows, batch_results) in batch order; batches that finish early wait in
+    their task until the ones before them are done.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT)
+    throttle = create_rate_limiter(REQUESTS_PER_SECOND)
 
-# ORCHESTRATOR
-def process_single_row_threaded(row, active_agents_dict):
-    answer_text = row.get('Answer')
-    answer_id = row.get('id', 'Unknown')
-
-    print(f" [ID: {answer_id}] Starting parallel evaluation...")
-
-    results_to_merge = {}
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_agent = {}
-
-        for name, (model, handler) in active_agents_dict.items():
-            future = executor.submit(
-                run_agent_threaded,
-                name,
-                model,
-                handler,
-                answer_text
-            )
-            future_to_agent[future] = name
-
-        for future in concurrent.futures.as_completed(future_to_agent):
-            try:
-                data = future.result()
-                results_to_merge.update(data)
-            except Exception as exc:
-                print(f"Thread exc: {exc}")
-
-    combined = row.copy()
-    combined.update(results_to_merge)
-    print(f" [ID: {answer_id}] Finished.")
-    return combined
+    batches = [rows[i:i + BATCH_SIZE] for i in range(0, len(rows), BATCH_SIZE)]
+    tasks = [
+        asyncio.create_task(process_batch_threaded(batch, active_agents_dict, semaphore, throttle))
+        for batch in batches
+    ]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def chunk_rows(chunk):
+    # Ids are only labels (report rows, PNG names), so any value is kept as text;
+    # rows without an id (no column, or a blank cell) are numbered by their row position
+    row_numbers = chunk.index.to_series(index=chunk.index).astype('string[pyarrow]')
+    if 'id' not in chunk.columns:
+        chunk = chunk.assign(id=row_numbers)
+    chunk = chunk.assign(
+        id=chunk['id'].astype('string[pyarrow]').fillna(row_numbers),
+        Answer=chunk['Answer'].fillna('')
+    )
+    return [row._asdict() for row in chunk.itertuples(index=False, name='Row')]
+
+def report_schema(agent_names):
+    """Fixed column types of the report, independent of whichever batch is written first."""
+    fields = [('id', pa.string()), ('Answer', pa.string())]
+    for name in agent_names:
+        fields += [
+            (f"{name}_grade", pa.int64()),
+            (f"{name}_reason", pa.string()),
+            (f"{name}_graph", pa.string())
+        ]
+    return pa.schema(fields)
+
+async def stream_report(chunks, active_agents_dict, output_filename):
+    """
+    Judges the input chunk by chunk and appends each judged chunk to the Parquet report as
+    one row group, in input order. Memory stays bounded by the chunk size; after a crash the
+    response cache makes re-judging the unfinished chunk free.
+    """
+    schema = report_schema(active_agents_dict)
+    writer = pq.ParquetWriter(output_filename, schema, compression="zstd")
+    try:
+        for chunk in chunks:
+            rows = chunk_rows(chunk)
+
+            # Identical answers are judged once and the verdict is copied to every duplicate
+            # (across chunks the response cache does the same job)
+            first_seen = {}
+            for row in rows:
+                first_seen.setdefault(row['Answer'], row)
+            unique_rows = list(first_seen.values())
+            print(f" {len(unique_rows)} unique answers out of {len(rows)} rows in this chunk.")
+
+            verdicts_by_answer = {}
+            async for batch_rows, results in evaluate_all_rows(unique_rows, active_agents_dict):
+                for judged_row, data in zip(batch_rows, results):
+                    verdicts_by_answer[judged_row['Answer']] = data
+
+            # One write per chunk keeps row groups large (a write per batch meant ~10-row groups)
+            enriched_rows = [{**row, **verdicts_by_answer[row['Answer']]} for row in rows]
+            writer.write_table(pa.Table.from_pylist(enriched_rows, schema=schema))
+    finally:
+        writer.close()
 
 def run_parallel_system_threaded(csv_path):
     try:
-        df = pd.read_csv(csv_path)
+        # Rows are independent, so the input is streamed instead of loaded at once
+        # Arrow-backed strings keep each chunk's footprint small
+        chunks = pd.read_csv(
+            csv_path,
+            chunksize=INPUT_CHUNK_SIZE,
+            usecols=lambda col: col in ('id', 'Answer'),
+            dtype={'id': 'string[pyarrow]', 'Answer': 'string[pyarrow]'},
+            dtype_backend='pyarrow'
+        )
     except:
         print("CSV not found, using dummy data.")
-        df = pd.DataFrame([
+        chunks = [pd.DataFrame([
             {"id": 101, "Answer": "The sun is cold and blue."},
             {"id": 102, "Answer": "I understand this is difficult. The treatment is effective."}
-        ])
-
-    agent_configs = [
-        ("Accuracy", check_accuracy, "Factually accurate, citing correct numbers."),
-        ("Completeness", check_completeness, "Addresses every aspect of the question."),
-        ("Empathy", check_empathy, "Tone is warm, understanding, and human-like.")
-    ]
+        ])]
 
-    active_agents = {}
-    print(" Initializing Agents...")
-    for name, func, desc in agent_configs:
-        model, handler = create_agent(name, func, desc)
-        active_agents[name] = (model, handler)
+    active_agents = {
+        "Accuracy": "Factually accurate, citing correct numbers.",
+        "Completeness": "Addresses every aspect of the question.",
+        "Empathy": "Tone is warm, understanding, and human-like."
+    }
 
-    final_rows = []
-    for index, row in df.iterrows():
-        row_dict = row.to_dict()
-        if 'id' not in row_dict: row_dict['id'] = index
+    output_filename = OUTPUT_PATH
+    asyncio.run(stream_report(chunks, active_agents, output_filename))
+    print(f"Done! Saved to {output_filename}")
 
-        enriched_row = process_single_row_threaded(row_dict, active_agents)
-        final_rows.append(enriched_row)
+# EXECUTE
+def main(csv_path="sm_answers.csv"):
+    if not configure_api():
+        return False
 
-        time.sleep(1)
+    # Upewnij się, że plik wejściowy istnieje
+    if not os.path.exists(csv_path):
+        print(f"Brak pliku {csv_path}. Uruchom najpierw skrypt generujący dane.")
+        return False
 
-    output_filename = "FINAL_threaded_report_with_graphs.csv"
-    pd.DataFrame(final_rows).to_csv(output_filename, index=False)
-    print(f"Done! Saved to {output_filename}")
+    run_parallel_system_threaded(csv_path)
+    return True
 
-# EXECUTE
 if __name__ == "__main__":
-    # Upewnij się, że plik wejściowy istnieje
-    if not os.path.exists("sm_answers.csv"):
-        print("Brak pliku sm_answers.csv. Uruchom najpierw skrypt generujący dane.")
-    else:
-        run_parallel_system_threaded("sm_answers.csv")
\ No newline at end of file
+    sys.exit(0 if main() else 1)